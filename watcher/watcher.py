@@ -4,45 +4,153 @@ Nginx Log Watcher for Blue/Green Deployment Monitoring
 """
 import os
 import time
-import re
+import orjson
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-from collections import deque
+import queue
+import threading
+from inotify_simple import INotify, flags
+from array import array
+from collections import OrderedDict
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+MAX_ALERT_TYPES = 16
+
+# Keys of the custom_format log_format in nginx.conf, in order
+LOG_FORMAT_KEYS = ('time', 'remote_addr', 'method', 'uri', 'status', 'body_bytes_sent',
+                   'request_time', 'upstream_addr', 'upstream_status',
+                   'upstream_response_time', 'pool', 'release')
+
+class CachedTimeFormatter(logging.Formatter):
+    """Formatter that runs strftime at most once per second"""
+    _cached_second = None
+    _cached_time = ''
+    
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        if second != self._cached_second:
+            self._cached_time = time.strftime(self.default_time_format, self.converter(second))
+            self._cached_second = second
+        return self.default_msec_format % (self._cached_time, record.msecs)
+
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(CachedTimeFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 
 class LogWatcher:
     def __init__(self):
         self.slack_webhook = os.getenv('SLACK_WEBHOOK_URL', '')
+        self.slack_enabled = bool(self.slack_webhook) and 'placeholder' not in self.slack_webhook
+        self.maintenance_mode = os.getenv('MAINTENANCE_MODE', 'false').lower() == 'true'
         self.last_pool = None
+        self.session = self.create_session()
+        self.alert_queue = queue.Queue(maxsize=64)
+        threading.Thread(target=self.alert_worker, daemon=True).start()
+        self.log_file = '/var/log/nginx/access.log'
+        self.fast_parse = self.compile_parser(LOG_FORMAT_KEYS)
+        self.error_rate_threshold = float(os.getenv('ERROR_RATE_THRESHOLD', '2'))
+        self.window_size = int(os.getenv('WINDOW_SIZE', '200'))
+        self.alert_cooldown = int(os.getenv('ALERT_COOLDOWN_SEC', '300'))
+        self.request_window = array('B', [0] * self.window_size)
+        self.window_cursor = 0
+        self.window_filled = 0
+        self.error_count = 0
+        self.last_alert_time = OrderedDict()
+        self.pending_alerts = set()
         logger.info(f"Watcher started. Slack webhook: {'Configured' if self.slack_webhook else 'Not configured'}")
+        if self.maintenance_mode:
+            logger.info("Maintenance mode enabled, alerts are suppressed")
         
+    def create_session(self):
+        """Create a keep-alive HTTP session for Slack webhooks"""
+        session = requests.Session()
+        retries = Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['POST']),
+            raise_on_status=False
+        )
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries))
+        return session
+    
+    def tokenize(self, tokens):
+        """Parse every key:value token"""
+        # nginx does not escape '|' in $request_uri, so a client can inject
+        # extra pool:/status: tokens. The real fields come after the URI,
+        # so the last occurrence of a key always wins, even when empty.
+        log_data = {}
+        for token in tokens:
+            key, sep, value = token.partition(':')
+            if sep:
+                log_data[key] = value
+        return log_data
+    
+    def compile_parser(self, keys):
+        """Build a parser specialized to the line layout nginx writes"""
+        size = len(keys)
+        pool_index = keys.index('pool')
+        status_index = keys.index('status')
+        
+        def parse(tokens):
+            if len(tokens) != size:
+                return None
+            pool = tokens[pool_index]
+            status = tokens[status_index]
+            if not (pool.startswith('pool:') and status.startswith('status:')):
+                return None
+            return {'pool': pool[5:], 'status': status[7:]}
+        
+        return parse
+    
     def parse_log_line(self, line):
         """Parse enhanced log format"""
+        # Lines without a pool field are not in the enhanced format
+        if 'pool:' not in line:
+            return None
+        
         try:
-            # Parse key=value pairs
-            pattern = r'(\w+):([^|]+)'
-            matches = re.findall(pattern, line)
-            log_data = dict(matches)
+            tokens = line.split('|')
+            log_data = self.fast_parse(tokens)
+            if log_data is None:
+                log_data = self.tokenize(tokens)
             
-            pool = log_data.get('pool', 'unknown')
-            status = log_data.get('status', '0')
+            pool = log_data.get('pool') or 'unknown'
+            status = log_data.get('status', '')
+            status = int(status) if status.isdigit() else 0
             
             return {
                 'pool': pool,
-                'status': int(status) if status.isdigit() else 0,
-                'upstream_status': log_data.get('upstream_status', ''),
-                'timestamp': log_data.get('time', '')
+                'status': status,
+                'is_5xx': 1 if 500 <= status < 600 else 0
             }
         except Exception as e:
             return None
     
-    def send_slack_alert(self, message):
-        """Send alert to Slack"""
-        if not self.slack_webhook or 'placeholder' in self.slack_webhook:
+    def cooldown_ok(self, alert_type):
+        """Check whether an alert type may be sent now, without starting a cooldown"""
+        if self.maintenance_mode or alert_type in self.pending_alerts:
+            return False
+        last = self.last_alert_time.get(alert_type)
+        return last is None or time.time() - last >= self.alert_cooldown
+    
+    def mark_alert_sent(self, alert_type):
+        """Start the cooldown for an alert type"""
+        self.last_alert_time[alert_type] = time.time()
+        self.last_alert_time.move_to_end(alert_type)
+        # Forget the least recently alerted types so the map stays bounded
+        while len(self.last_alert_time) > MAX_ALERT_TYPES:
+            self.last_alert_time.popitem(last=False)
+    
+    def send_slack_alert(self, message, alert_type):
+        """Queue an alert for delivery to Slack"""
+        if not self.slack_enabled:
             logger.warning(f"Would send Slack alert: {message}")
+            self.mark_alert_sent(alert_type)
             return False
             
         payload = {
@@ -51,10 +159,22 @@ class LogWatcher:
             "icon_emoji": ":warning:"
         }
         
+        # Mark pending before enqueueing so the worker's discard cannot race ahead
+        self.pending_alerts.add(alert_type)
         try:
-            response = requests.post(
+            self.alert_queue.put_nowait((message, alert_type, payload))
+            return True
+        except queue.Full:
+            self.pending_alerts.discard(alert_type)
+            logger.error(f"Slack alert queue full, dropping alert: {message}")
+            return False
+    
+    def post_slack_alert(self, message, payload):
+        """Post an alert payload to the Slack webhook"""
+        try:
+            response = self.session.post(
                 self.slack_webhook,
-                json=payload,
+                data=orjson.dumps(payload),
                 headers={'Content-Type': 'application/json'},
                 timeout=5
             )
@@ -68,32 +188,105 @@ class LogWatcher:
             logger.error(f"Slack request failed: {e}")
             return False
     
+    def alert_worker(self):
+        """Deliver queued Slack alerts off the log tailing thread"""
+        while True:
+            message, alert_type, payload = self.alert_queue.get()
+            # Only a delivered alert starts the cooldown, so a failed post
+            # is retried on the next trigger
+            if self.post_slack_alert(message, payload):
+                self.mark_alert_sent(alert_type)
+            self.pending_alerts.discard(alert_type)
+            self.alert_queue.task_done()
+    
     def detect_failover(self, current_pool):
         """Detect and alert on pool changes"""
         if self.last_pool and current_pool != self.last_pool and current_pool != 'unknown':
             message = f"Failover detected! From {self.last_pool} to {current_pool}"
             logger.info(message)
-            self.send_slack_alert(message)
+            alert_type = f"failover_{current_pool}"
+            if self.cooldown_ok(alert_type):
+                self.send_slack_alert(message, alert_type)
         
         if current_pool != 'unknown':
             self.last_pool = current_pool
     
-    def process_logs(self):
-        """Process new log lines"""
-        log_file = '/var/log/nginx/access.log'
+    def push_error_flag(self, is_5xx):
+        """Store a request's 5xx flag in the window and return the one it replaced"""
+        # Unused slots hold 0, so nothing is subtracted while the window fills
+        evicted = self.request_window[self.window_cursor]
+        self.request_window[self.window_cursor] = is_5xx
+        self.window_cursor = (self.window_cursor + 1) % self.window_size
+        if self.window_filled < self.window_size:
+            self.window_filled += 1
+        return evicted
+    
+    def calculate_error_rate(self):
+        """Return the 5xx rate (percent) and 5xx count over the request window"""
+        return self.error_count / self.window_filled * 100, self.error_count
+    
+    def monitor_error_rate(self, is_5xx):
+        """Track 5xx responses and alert when the rate exceeds the threshold"""
+        # Running 5xx count: add the new request, subtract the one it replaced
+        self.error_count += is_5xx - self.push_error_flag(is_5xx)
+        if self.window_filled < self.window_size:
+            return
         
+        error_rate, error_count = self.calculate_error_rate()
+        if error_rate > self.error_rate_threshold and self.cooldown_ok('error_rate'):
+            message = (f"High error rate: {error_rate:.2f}% 5xx "
+                       f"({error_count}/{self.window_size} requests, threshold {self.error_rate_threshold}%)")
+            logger.warning(message)
+            self.send_slack_alert(message, 'error_rate')
+    
+    def process_line(self, line):
+        """Process a single log line"""
+        log_data = self.parse_log_line(line.strip())
+        if log_data and log_data['pool']:
+            logger.info("Processed: pool=%s, status=%s", log_data['pool'], log_data['status'])
+            self.detect_failover(log_data['pool'])
+            self.monitor_error_rate(log_data['is_5xx'])
+    
+    def open_log(self, from_end=False):
+        """Open the access log and watch it for writes"""
+        self.log = open(self.log_file, 'r')
+        self.partial_line = ''
+        if from_end:
+            self.log.seek(0, os.SEEK_END)
+        try:
+            self.wd = self.inotify.add_watch(self.log_file, flags.MODIFY)
+        except OSError:
+            self.log.close()
+            self.log = None
+            raise
+        logger.info(f"Tailing {self.log_file}")
+    
+    def close_log(self):
+        """Stop watching and close the current log file"""
         try:
-            if not os.path.exists(log_file):
-                logger.warning(f"Log file not found: {log_file}")
+            self.inotify.rm_watch(self.wd)
+        except OSError:
+            # Watch is already gone when the file was deleted
+            pass
+        self.log.close()
+    
+    def process_logs(self):
+        """Process log lines appended since the last read"""
+        try:
+            if os.fstat(self.log.fileno()).st_size < self.log.tell():
+                logger.info("Log file truncated, reading from start")
+                self.log.seek(0)
+                self.partial_line = ''
+            
+            # Drain everything available in one read; a trailing line
+            # without a newline is still being written, keep it for later
+            chunk = self.log.read()
+            if not chunk:
                 return
-                
-            with open(log_file, 'r') as f:
-                lines = f.readlines()
-                for line in lines:
-                    log_data = self.parse_log_line(line.strip())
-                    if log_data and log_data['pool']:
-                        logger.info(f"Processed: pool={log_data['pool']}, status={log_data['status']}")
-                        self.detect_failover(log_data['pool'])
+            lines = (self.partial_line + chunk).split('\n')
+            self.partial_line = lines.pop()
+            for line in lines:
+                self.process_line(line)
         except Exception as e:
             logger.error(f"Error processing logs: {e}")
     
@@ -101,9 +294,37 @@ class LogWatcher:
         """Main loop"""
         logger.info("Starting log watcher service")
         
+        # Watch the directory too, so a newly created (or rotated-in) log
+        # file wakes us up without polling for it
+        self.inotify = INotify()
+        log_dir, log_name = os.path.split(self.log_file)
+        dir_wd = self.inotify.add_watch(log_dir, flags.CREATE | flags.MOVED_TO)
+        
+        self.log = None
+        try:
+            self.open_log(from_end=True)
+        except OSError:
+            logger.warning(f"Log file not found, waiting for {self.log_file}")
+        
         while True:
-            self.process_logs()
-            time.sleep(5)
+            replaced = False
+            for event in self.inotify.read():
+                if event.wd == dir_wd and event.name == log_name:
+                    replaced = True
+            
+            if self.log:
+                self.process_logs()
+            
+            if replaced:
+                logger.info("New log file created, reopening")
+                if self.log:
+                    self.close_log()
+                    self.log = None
+                try:
+                    self.open_log()
+                except OSError as e:
+                    # The new file vanished again; the next CREATE/MOVED_TO retries
+                    logger.warning(f"Could not reopen {self.log_file}, waiting for it: {e}")
 
 if __name__ == "__main__":
     watcher = LogWatcher()